@@ -1,75 +1,246 @@
 import asyncio
-import json
+import sys
+import time
+import threading
+import orjson
 import websockets
 import logging
-import tomli
+import numpy as np
 from warnings import simplefilter
 from langchain.chains import create_history_aware_retriever, create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_community.vectorstores import Chroma
 from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_community.chat_models import ChatOllama
-from langchain_community.embeddings.sentence_transformer import SentenceTransformerEmbeddings
+from embeddings import get_embedder
+from fast_cache import lsh_sign_pack, cosine_topk
+from config import CFG
 
 simplefilter(action="ignore", category=FutureWarning)
 
-class ConfigLoader:
-    def __init__(self, filepath):
-        self.config = self.load_config(filepath)
-    
-    def load_config(self, filepath):
+CONTEXTUALIZE_Q_SYSTEM_PROMPT = (
+    "Given a chat history and the latest user question which might reference context in the "
+    "chat history, formulate a standalone question which can be understood without the chat "
+    "history. Do NOT answer the question, just reformulate it if needed and otherwise return it as is."
+)
+
+QA_SYSTEM_PROMPT = (
+    "You are an assistant for question-answering tasks. You are named 'NydasBot'. Use the "
+    "following pieces of retrieved context to answer the question. If you don't know the answer, "
+    "just say that you don't know. Use three sentences maximum and keep the answer concise."
+)
+
+DRAFT_SYSTEM_PROMPT = (
+    "Answer the question using only the following piece of context. If it doesn't contain the "
+    "answer, just say that it doesn't. Keep the answer to one or two sentences."
+)
+
+CONTEXT_QUESTION_PROMPT = "Context:\n{context}\n\nQuestion: {input}"
+
+class SemanticCache:
+    def __init__(self, dimensions, num_tables, num_bits, threshold, max_entries, ttl_seconds=0, seed=None):
+        # Signatures are packed into a uint64, one bit per projection
+        if not 1 <= num_bits <= 64:
+            raise ValueError(f"num_bits must be between 1 and 64, got {num_bits}")
+        rng = np.random.default_rng(seed)
+        self.projections = np.ascontiguousarray(
+            rng.standard_normal((num_tables, num_bits, dimensions)), dtype=np.float32
+        )
+        self.tables = [{} for _ in range(num_tables)]
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        # Entries live in a fixed ring of slots; once it is full the oldest slot is overwritten
+        self.embeddings = np.zeros((max_entries, dimensions), dtype=np.float32)
+        self.norms = np.ones(max_entries, dtype=np.float32)
+        self.signatures_by_slot = np.zeros((max_entries, num_tables), dtype=np.uint64)
+        self.inserted_at = np.zeros(max_entries, dtype=np.float64)
+        self.answers = [None] * max_entries
+        self.next_slot = 0
+        # Lookups run in worker threads while inserts run on the event loop
+        self.lock = threading.Lock()
+
+    def signatures(self, embedding):
         """
-        Loads the configuration from the given file.
+        Hashes an embedding to its random-projection LSH signature in every table.
 
         Args:
-            filepath (str): The path to the TOML file.
+            embedding (np.ndarray): The float32 C-contiguous query embedding.
 
         Returns:
-            dict: The loaded configuration.
+            np.ndarray: One uint64 signature per table.
+        """
+        signatures = np.empty(len(self.tables), dtype=np.uint64)
+        lsh_sign_pack(embedding, self.projections, signatures)
+        return signatures
 
+    def lookup(self, embedding):
         """
-        with open(filepath, "rb") as params:
-            return tomli.load(params)
+        Looks up a cached answer for a semantically similar query.
+
+        The unexpired candidates from each table's bucket are scored together and the best
+        one is returned if its cosine similarity is at or above the threshold.
+
+        Args:
+            embedding (np.ndarray): The float32 C-contiguous query embedding.
+
+        Returns:
+            str | None: The cached answer, or None on a miss.
+        """
+        signatures = self.signatures(embedding)
+        with self.lock:
+            candidates = set()
+            for signature, table in zip(signatures, self.tables):
+                candidates.update(table.get(int(signature), ()))
+            if self.ttl_seconds > 0:
+                expiry = time.monotonic() - self.ttl_seconds
+                candidates = {slot for slot in candidates if self.inserted_at[slot] >= expiry}
+            if not candidates:
+                return None
+
+            slots = np.fromiter(candidates, dtype=np.int64)
+            best, scores = cosine_topk(embedding, self.embeddings[slots], self.norms[slots], 1)
+            if scores[0] >= self.threshold:
+                return self.answers[slots[best[0]]]
+            return None
+
+    def insert(self, embedding, answer):
+        """
+        Adds a query embedding and its answer to every table.
+
+        If the cache is full, the oldest entry is evicted to make room.
+
+        Args:
+            embedding (np.ndarray): The float32 C-contiguous query embedding.
+            answer (str): The answer to cache.
+
+        Returns:
+            None
+        """
+        signatures = self.signatures(embedding)
+        with self.lock:
+            slot = self.next_slot
+            self.next_slot = (slot + 1) % len(self.answers)
+            if self.answers[slot] is not None:
+                self.evict(slot)
+
+            self.embeddings[slot] = embedding
+            self.norms[slot] = np.linalg.norm(embedding)
+            self.signatures_by_slot[slot] = signatures
+            self.inserted_at[slot] = time.monotonic()
+            self.answers[slot] = answer
+            for signature, table in zip(signatures, self.tables):
+                table.setdefault(int(signature), []).append(slot)
+
+    def evict(self, slot):
+        """
+        Removes the entry in a slot from every table. The caller must hold the lock.
+
+        Args:
+            slot (int): The slot to evict.
+
+        Returns:
+            None
+        """
+        for signature, table in zip(self.signatures_by_slot[slot], self.tables):
+            bucket = table[int(signature)]
+            bucket.remove(slot)
+            if not bucket:
+                del table[int(signature)]
+        self.answers[slot] = None
+
+class BoundedChatMessageHistory(ChatMessageHistory):
+    max_messages: int = 20
+
+    def add_message(self, message):
+        """
+        Adds a message to the history, dropping the oldest messages beyond `max_messages`.
+
+        Messages are dropped in whole question/answer pairs, so the history never starts with
+        an answer whose question has been trimmed.
+
+        Args:
+            message (BaseMessage): The message to add.
+
+        Returns:
+            None
+        """
+        self.messages.append(message)
+        excess = len(self.messages) - self.max_messages
+        if excess > 0:
+            del self.messages[:excess + excess % 2]
 
 class RAGModel:
     def __init__(self, config):
         self.config = config
         self.llm = self.setup_llm()
+        self.embedding_function = self.setup_embeddings()
         self.retriever = self.setup_retriever()
         self.rag_chain = self.setup_rag_chain()
+        self.conversational_rag_chain = self.setup_conversational_chain()
         self.store = {}
+        self.semantic_cache = self.setup_semantic_cache()
     
     def setup_llm(self):
         """
         Sets up the ChatOllama model for the agent.
 
+        `keep_alive` keeps the model loaded in Ollama between turns so that the KV cache of
+        the shared prompt prefix can be reused rather than prefilled again.
+
         Returns:
             ChatOllama: The initialized ChatOllama model.
         """
-        local_llm = self.config["llm"]["model"]
+        local_llm = self.config.llm.model
         return ChatOllama(
             model=local_llm, 
             temperature=0,
+            keep_alive=self.config.llm.keep_alive,
+            num_ctx=self.config.llm.num_ctx,
+        )
+    
+    def setup_embeddings(self):
+        """
+        Sets up the embedding model shared by the retriever and the semantic cache.
+
+        Returns:
+            QuantizedEmbeddings: The initialized embedding model.
+        """
+        embedding_model = self.config.llm.embedding_model
+        onnx_model_path = self.config.llm.onnx_model_path
+        device = self.config.llm.device
+        batch_size = self.config.llm.batch_size
+
+        return get_embedder(
+            model_name=embedding_model,
+            model_path=onnx_model_path,
+            device=device,
+            batch_size=batch_size,
         )
     
     def setup_retriever(self):
         """
         Sets up and returns a retriever object for vector retrieval.
 
+        The HNSW index parameters and the number of documents retrieved are read from the
+        `[rag]` section of the config. `hnsw:space`, `hnsw:M` and `hnsw:construction_ef` only
+        take effect when the collection is first created.
+
         Returns:
             retriever: A retriever object for vector retrieval.
         """
-        embedding_model = self.config["llm"]["embedding_model"]
-        vector_store_path = self.config["rag"]["vector_store_path"]
+        vector_store_path = self.config.rag.vector_store_path
         
-        embedding_function = SentenceTransformerEmbeddings(model_name=embedding_model)
         vectorstore = Chroma(
+            collection_name=self.config.rag.collection_name,
             persist_directory=vector_store_path,
-            embedding_function=embedding_function,
+            embedding_function=self.embedding_function,
+            collection_metadata=self.config.rag.collection_metadata,
         )
-        return vectorstore.as_retriever()
+        return vectorstore.as_retriever(search_kwargs={"k": self.config.rag.top_k})
     
     def setup_rag_chain(self):
         """
@@ -78,18 +249,17 @@ class RAGModel:
         This method configures the RAG chain by defining the prompts and templates
         used for contextualizing questions and generating answers.
 
+        The history aware retriever only calls the LLM to reformulate the question when
+        there is chat history; on the first turn of a session the input goes straight to
+        the retriever.
+
         Returns:
             The configured RAG chain.
 
         """
-        contextualize_q_system_prompt = """Given a chat history and the latest user question \
-        which might reference context in the chat history, formulate a standalone question \
-        which can be understood without the chat history. Do NOT answer the question, \
-        just reformulate it if needed and otherwise return it as is."""
-
         contextualize_q_prompt = ChatPromptTemplate.from_messages(
             [
-                ("system", contextualize_q_system_prompt),
+                ("system", CONTEXTUALIZE_Q_SYSTEM_PROMPT),
                 MessagesPlaceholder("chat_history"),
                 ("human", "{input}"),
             ]
@@ -98,43 +268,162 @@ class RAGModel:
             self.llm, self.retriever, contextualize_q_prompt
         )
 
-        qa_system_prompt = """You are an assistant for question-answering tasks. \
-        You are named 'NydasBot'. Use the following pieces of retrieved context to \
-        answer the question. If you don't know the answer, just say that you don't know. \
-        Use three sentences maximum and keep the answer concise.\n\n{context}"""
-
+        # The retrieved context goes in the last message, after the system prompt and chat history,
+        # so the start of the prompt stays the same from turn to turn and Ollama can reuse its KV cache
         qa_prompt = ChatPromptTemplate.from_messages(
             [
-                ("system", qa_system_prompt),
+                ("system", QA_SYSTEM_PROMPT),
                 MessagesPlaceholder("chat_history"),
-                ("human", "{input}"),
+                ("human", CONTEXT_QUESTION_PROMPT),
             ]
         )
-        question_answer_chain = create_stuff_documents_chain(self.llm, qa_prompt)
+        if self.config.rag.sparse_parallel:
+            question_answer_chain = self.setup_sparse_documents_chain(qa_prompt)
+        else:
+            question_answer_chain = create_stuff_documents_chain(self.llm, qa_prompt)
 
         return create_retrieval_chain(history_aware_retriever, question_answer_chain)
     
+    def setup_sparse_documents_chain(self, qa_prompt):
+        """
+        Sets up a documents chain that reads each retrieved document in a separate, parallel LLM call.
+
+        Each document gets its own small prompt that drafts an answer from that document
+        alone. The drafts are then passed to `qa_prompt` as the context for the final answer.
+        This uses more tokens in total than stuffing every document into one prompt, but the
+        drafts run concurrently, which lowers latency when Ollama serves several requests in parallel.
+
+        Args:
+            qa_prompt (ChatPromptTemplate): The prompt used to write the final answer.
+
+        Returns:
+            The configured documents chain.
+        """
+        draft_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", DRAFT_SYSTEM_PROMPT),
+                ("human", CONTEXT_QUESTION_PROMPT),
+            ]
+        )
+        draft_chain = draft_prompt | self.llm | StrOutputParser()
+
+        def draft_inputs(inputs):
+            return [{"context": doc.page_content, "input": inputs["input"]} for doc in inputs["context"]]
+
+        def draft(inputs):
+            drafts = draft_chain.batch(draft_inputs(inputs))
+            return {**inputs, "context": "\n\n".join(drafts)}
+
+        async def adraft(inputs):
+            drafts = await draft_chain.abatch(draft_inputs(inputs))
+            return {**inputs, "context": "\n\n".join(drafts)}
+
+        merge_chain = qa_prompt | self.llm | StrOutputParser()
+
+        return (RunnableLambda(draft, afunc=adraft) | merge_chain).with_config(run_name="sparse_documents_chain")
+    
+    def setup_conversational_chain(self):
+        """
+        Wraps the RAG chain so that it reads and updates the session chat history.
+
+        Returns:
+            RunnableWithMessageHistory: The conversational RAG chain.
+        """
+        return RunnableWithMessageHistory(
+            self.rag_chain,
+            self.get_session_history,
+            input_messages_key="input",
+            history_messages_key="chat_history",
+            output_messages_key="answer",
+        )
+    
     def get_session_history(self, session_id):
         """
         Retrieves the chat message history for a given session ID.
 
-        If the session ID is not found in the store, a new ChatMessageHistory object is created
-        and added to the store before returning it.
+        If the session ID is not found in the store, a new BoundedChatMessageHistory object is created
+        and added to the store before returning it. Only the most recent `max_history_messages`
+        messages are kept, so the prompt doesn't grow with the length of the session.
 
         Parameters:
         - session_id (str): The ID of the session for which to retrieve the chat message history.
 
         Returns:
-        - ChatMessageHistory: The chat message history for the specified session ID.
+        - BoundedChatMessageHistory: The chat message history for the specified session ID.
         """
         if session_id not in self.store:
-            self.store[session_id] = ChatMessageHistory()
+            self.store[session_id] = BoundedChatMessageHistory(
+                max_messages=self.config.rag.max_history_messages
+            )
         return self.store[session_id]
     
+    def setup_semantic_cache(self):
+        """
+        Sets up the semantic cache shared by all sessions.
+
+        Returns:
+            SemanticCache | None: The semantic cache, or None if it is disabled.
+        """
+        if not self.config.cache.enabled:
+            return None
+        return SemanticCache(
+            self.embedding_function.model.get_sentence_embedding_dimension(),
+            num_tables=self.config.cache.num_tables,
+            num_bits=self.config.cache.num_bits,
+            threshold=self.config.cache.threshold,
+            max_entries=self.config.cache.max_entries,
+            ttl_seconds=self.config.cache.ttl_seconds,
+        )
+    
+    def lookup_cached_answer(self, input_text, session_id):
+        """
+        Looks up a cached answer for the input text in the semantic cache.
+
+        Answers depend on the chat history, so only the first question of a session, which
+        has no history, is looked up; follow-ups such as "tell me more" always go to the
+        RAG chain. This also means cached answers can be shared between sessions.
+        On a hit the turn is added to the session history, as the RAG chain would have done.
+
+        Args:
+            input_text (str): The input text to look up.
+            session_id (str): The session ID the question belongs to.
+
+        Returns:
+            tuple: The cached answer (or None on a miss) and the query embedding to pass to
+            `cache_answer`. Both are None if the cache is disabled or the session has history.
+        """
+        history = self.get_session_history(session_id)
+        if self.semantic_cache is None or history.messages:
+            return None, None
+
+        embedding = np.ascontiguousarray(self.embedding_function.embed_query(input_text), dtype=np.float32)
+        answer = self.semantic_cache.lookup(embedding)
+        if answer is not None:
+            history.add_user_message(input_text)
+            history.add_ai_message(answer)
+        return answer, embedding
+    
+    def cache_answer(self, embedding, answer):
+        """
+        Stores an answer in the semantic cache.
+
+        Args:
+            embedding (np.ndarray | None): The query embedding from `lookup_cached_answer`.
+            answer (str): The answer to cache.
+
+        Returns:
+            None
+        """
+        if embedding is not None:
+            self.semantic_cache.insert(embedding, answer)
+    
     def get_answer(self, input_text, session_id):
         """
         Retrieves an answer from the conversational RAG chain model based on the given input text and session ID.
 
+        If the semantic cache is enabled and a near-duplicate of the first question of a session
+        has already been answered, the cached answer is returned and the chain is skipped.
+
         Args:
             input_text (str): The input text for generating the answer.
             session_id (str): The session ID for maintaining conversation history.
@@ -142,24 +431,116 @@ class RAGModel:
         Returns:
             str: The generated answer from the conversational RAG chain model.
         """
-        conversational_rag_chain = RunnableWithMessageHistory(
-            self.rag_chain,
-            self.get_session_history,
-            input_messages_key="input",
-            history_messages_key="chat_history",
-            output_messages_key="answer",
-        )
-        
-        return conversational_rag_chain.invoke(
+        answer, embedding = self.lookup_cached_answer(input_text, session_id)
+        if answer is not None:
+            return answer
+
+        answer = self.conversational_rag_chain.invoke(
             {"input": input_text},
             config={"configurable": {"session_id": session_id}}
         )["answer"]
 
+        self.cache_answer(embedding, answer)
+        return answer
+    
+    async def aget_answer(self, input_text, session_id):
+        """
+        Asynchronous version of `get_answer`.
+
+        The semantic cache lookup runs in a worker thread and the chain is awaited with `ainvoke`,
+        so the event loop can keep serving other sessions while an answer is generated.
+
+        Args:
+            input_text (str): The input text for generating the answer.
+            session_id (str): The session ID for maintaining conversation history.
+
+        Returns:
+            str: The generated answer from the conversational RAG chain model.
+        """
+        answer, embedding = await asyncio.to_thread(self.lookup_cached_answer, input_text, session_id)
+        if answer is not None:
+            return answer
+
+        answer = (await self.conversational_rag_chain.ainvoke(
+            {"input": input_text},
+            config={"configurable": {"session_id": session_id}}
+        ))["answer"]
+
+        self.cache_answer(embedding, answer)
+        return answer
+    
+    async def astream_answer(self, input_text, session_id):
+        """
+        Streams an answer from the conversational RAG chain model as it is generated.
+
+        A cached answer is yielded as a single chunk. The cache lookup runs in a worker thread
+        so it doesn't block the event loop.
+
+        Args:
+            input_text (str): The input text for generating the answer.
+            session_id (str): The session ID for maintaining conversation history.
+
+        Yields:
+            str: The next piece of the generated answer.
+        """
+        answer, embedding = await asyncio.to_thread(self.lookup_cached_answer, input_text, session_id)
+        if answer is not None:
+            yield answer
+            return
+
+        chunks = []
+        async for chunk in self.conversational_rag_chain.astream(
+            {"input": input_text},
+            config={"configurable": {"session_id": session_id}}
+        ):
+            if "answer" in chunk:
+                chunks.append(chunk["answer"])
+                yield chunk["answer"]
+
+        self.cache_answer(embedding, "".join(chunks))
+
+LOOPBACK_HOSTS = ("localhost", "127.0.0.1")
+
 class WebSocketServer:
-    def __init__(self, host, port, model):
+    def __init__(self, host, port, model, compression=False, stream_batch_bytes=0, stream_flush_interval=0.05):
         self.host = host
         self.port = port
         self.model = model
+        self.compression = compression
+        self.stream_batch_bytes = stream_batch_bytes
+        self.stream_flush_interval = stream_flush_interval
+    
+    async def stream_answer(self, websocket, input_text, session_id):
+            """
+            Streams the answer to the client, coalescing the generated chunks into larger frames.
+
+            Buffered chunks are sent as a `partial` frame once they reach `stream_batch_bytes`
+            or `stream_flush_interval` seconds have passed since the last frame. The final frame
+            carries `done` so the client knows the answer is complete.
+
+            Parameters:
+            - websocket: The WebSocket connection object.
+            - input_text (str): The input text for generating the answer.
+            - session_id (str): The session ID for maintaining conversation history.
+
+            Returns:
+            None
+            """
+            loop = asyncio.get_running_loop()
+            buffer = []
+            buffered_bytes = 0
+            last_flush = loop.time()
+
+            async for chunk in self.model.astream_answer(input_text, session_id):
+                buffer.append(chunk)
+                buffered_bytes += len(chunk.encode())
+                if buffered_bytes >= self.stream_batch_bytes or loop.time() - last_flush >= self.stream_flush_interval:
+                    await websocket.send(orjson.dumps({"partial": "".join(buffer)}).decode())
+                    buffer.clear()
+                    buffered_bytes = 0
+                    last_flush = loop.time()
+
+            await websocket.send(orjson.dumps({"partial": "".join(buffer), "done": True}).decode())
     
     async def handle_connection(self, websocket, path):
             """
@@ -175,18 +556,26 @@ class WebSocketServer:
             """
             async for message in websocket:
                 try:
-                    data = json.loads(message)
+                    data = orjson.loads(message)
                     session_id = data.get("session_id", "default_session")
                     input_text = data["input"]
 
-                    answer = self.model.get_answer(input_text, session_id)
+                    if self.stream_batch_bytes > 0:
+                        await self.stream_answer(websocket, input_text, session_id)
+                        continue
+
+                    answer = await self.model.aget_answer(input_text, session_id)
                     
                     response = {"answer": answer}
-                    await websocket.send(json.dumps(response))
+                    await websocket.send(orjson.dumps(response).decode())
+                except orjson.JSONDecodeError as e:
+                    logging.error(f"Invalid message: {e}")
+                    error_response = {"error": f"Invalid JSON: {e}"}
+                    await websocket.send(orjson.dumps(error_response).decode())
                 except Exception as e:
                     logging.error(f"An error occurred: {e}")
                     error_response = {"error": str(e)}
-                    await websocket.send(json.dumps(error_response))
+                    await websocket.send(orjson.dumps(error_response).decode())
     
     async def start_server(self):
             """
@@ -196,6 +585,9 @@ class WebSocketServer:
             and binds it to the specified `host` and `port`. It then waits for incoming
             connections and handles each connection using the `handle_connection` method.
 
+            permessage-deflate compression is disabled when serving on a loopback address,
+            unless `compression` is set.
+
             Note: This method runs indefinitely until the program is terminated.
 
             Parameters:
@@ -204,16 +596,36 @@ class WebSocketServer:
             Returns:
                 None
             """
-            async with websockets.serve(self.handle_connection, self.host, self.port):
+            if self.compression or self.host not in LOOPBACK_HOSTS:
+                compression = "deflate"
+            else:
+                compression = None
+
+            async with websockets.serve(self.handle_connection, self.host, self.port, compression=compression):
                 await asyncio.Future()  # run forever
 
 if __name__ == "__main__":
-    config_loader = ConfigLoader("parameters.toml")
-
-    logging.basicConfig(level = config_loader.config["general"]["logging_level"])
+    logging.basicConfig(level = CFG.general.logging_level)
     
-    rag_model = RAGModel(config_loader.config)
+    rag_model = RAGModel(CFG)
     
-    server = WebSocketServer("localhost", config_loader.config["general"]["port"], rag_model)
+    server = WebSocketServer(
+        "localhost",
+        CFG.general.port,
+        rag_model,
+        compression=CFG.general.websocket_compression,
+        stream_batch_bytes=CFG.general.stream_batch_bytes,
+        stream_flush_interval=CFG.general.stream_flush_interval,
+    )
     
-    asyncio.run(server.start_server())
+    try:
+        import uvloop  # not available on Windows
+    except ImportError:
+        logging.info("uvloop is not installed, using the default asyncio event loop.")
+        asyncio.run(server.start_server())
+    else:
+        if sys.version_info >= (3, 12):
+            asyncio.run(server.start_server(), loop_factory=uvloop.new_event_loop)
+        else:
+            uvloop.install()
+            asyncio.run(server.start_server())
@@ -0,0 +1,98 @@
+import tomli
+from dataclasses import dataclass
+
+@dataclass(slots=True, frozen=True)
+class GeneralConfig:
+    logging_level: int
+    port: int
+    websocket_compression: bool
+    stream_batch_bytes: int
+    stream_flush_interval: float
+
+@dataclass(slots=True, frozen=True)
+class LLMConfig:
+    model_path: str
+    model: str
+    embedding_model: str
+    onnx_model_path: str
+    device: str
+    batch_size: int
+    keep_alive: str
+    num_ctx: int
+
+@dataclass(slots=True, frozen=True)
+class RAGConfig:
+    source_file_location: str
+    processed_file_location: str
+    vector_store_path: str
+    collection_name: str
+    extract_images: bool
+    ocr_min_chars: int
+    max_history_messages: int
+    top_k: int
+    sparse_parallel: bool
+    hnsw_space: str
+    hnsw_m: int
+    hnsw_construction_ef: int
+    hnsw_search_ef: int
+
+    def __post_init__(self):
+        if self.max_history_messages <= 0 or self.max_history_messages % 2:
+            raise ValueError("rag.max_history_messages must be a positive, even number of messages")
+
+    @property
+    def collection_metadata(self):
+        """
+        Builds the Chroma collection metadata holding the HNSW index parameters.
+
+        Returns:
+            dict: The collection metadata.
+        """
+        return {
+            "hnsw:space": self.hnsw_space,
+            "hnsw:M": self.hnsw_m,
+            "hnsw:construction_ef": self.hnsw_construction_ef,
+            "hnsw:search_ef": self.hnsw_search_ef,
+        }
+
+@dataclass(slots=True, frozen=True)
+class CacheConfig:
+    enabled: bool
+    threshold: float
+    num_tables: int
+    num_bits: int
+    max_entries: int
+    ttl_seconds: float
+
+@dataclass(slots=True, frozen=True)
+class AppConfig:
+    general: GeneralConfig
+    llm: LLMConfig
+    rag: RAGConfig
+    cache: CacheConfig
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        Loads the configuration from the given file.
+
+        A missing or unknown key in any section raises a TypeError and an invalid value
+        raises a ValueError, so configuration errors are caught at startup rather than on
+        first use.
+
+        Args:
+            filepath (str): The path to the TOML file.
+
+        Returns:
+            AppConfig: The loaded configuration.
+        """
+        with open(filepath, "rb") as params:
+            config = tomli.load(params)
+        return cls(
+            general=GeneralConfig(**config["general"]),
+            llm=LLMConfig(**config["llm"]),
+            rag=RAGConfig(**config["rag"]),
+            cache=CacheConfig(**config["cache"]),
+        )
+
+CFG = AppConfig.load("parameters.toml")
@@ -0,0 +1,127 @@
+import os
+from functools import lru_cache
+from pathlib import Path
+import onnxruntime as ort
+from langchain_core.embeddings import Embeddings
+from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+QUANTIZED_FILE_NAME = "onnx/model_qint8_avx512_vnni.onnx"
+
+def session_options():
+    """
+    Builds the ONNX Runtime session options used for the embedding model.
+
+    Returns:
+        ort.SessionOptions: Session options with full graph optimisation and one intra-op thread per core.
+    """
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = os.cpu_count()
+    return options
+
+def export_quantized_model(model_name, model_path):
+    """
+    Exports an INT8 (AVX-512 VNNI) quantized ONNX copy of the embedding model.
+
+    The export only happens once; if the quantized file already exists in `model_path`
+    it is reused.
+
+    Args:
+        model_name (str): The HuggingFace name of the SentenceTransformer model.
+        model_path (str): The local folder the ONNX model is saved to.
+
+    Returns:
+        None
+    """
+    if (Path(model_path) / QUANTIZED_FILE_NAME).exists():
+        return
+    model = SentenceTransformer(model_name, backend="onnx", device="cpu")
+    model.save_pretrained(model_path)
+    export_dynamic_quantized_onnx_model(model, "avx512_vnni", model_path)
+
+def load_quantized_model(model_name, model_path, device="cpu"):
+    """
+    Loads the INT8 quantized ONNX embedding model, exporting it first if required.
+
+    Args:
+        model_name (str): The HuggingFace name of the SentenceTransformer model.
+        model_path (str): The local folder holding the ONNX model.
+        device (str): The device to run the model on.
+
+    Returns:
+        SentenceTransformer: The quantized model.
+    """
+    export_quantized_model(model_name, model_path)
+    return SentenceTransformer(
+        model_path,
+        device=device,
+        backend="onnx",
+        model_kwargs={
+            "file_name": QUANTIZED_FILE_NAME,
+            "provider": "CPUExecutionProvider",
+            "session_options": session_options(),
+        },
+    )
+
+class QuantizedEmbeddings(Embeddings):
+    """
+    LangChain Embeddings adapter around the INT8 quantized ONNX SentenceTransformer.
+    """
+    def __init__(self, model_name, model_path, device="cpu", batch_size=32):
+        self.model = load_quantized_model(model_name, model_path, device)
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts):
+        """
+        Embeds a list of documents.
+
+        Args:
+            texts (list[str]): The texts to embed.
+
+        Returns:
+            list[list[float]]: One embedding per text.
+        """
+        return self.model.encode(
+            list(texts),
+            batch_size=self.batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+        ).tolist()
+
+    def embed_query(self, text):
+        """
+        Embeds a single query.
+
+        Recent queries are memoised, so the semantic cache lookup and the retriever
+        only encode the same question once.
+
+        Args:
+            text (str): The text to embed.
+
+        Returns:
+            list[float]: The embedding.
+        """
+        return list(self._embed_query(text))
+
+    @lru_cache(maxsize=256)
+    def _embed_query(self, text):
+        return tuple(self.embed_documents([text])[0])
+
+@lru_cache(maxsize=1)
+def get_embedder(model_name, model_path, device="cpu", batch_size=32):
+    """
+    Returns the shared embedding model, loading it on first use.
+
+    The retriever, the semantic cache and the ingestion pipeline all go through this
+    function so the model weights and ONNX session are only loaded once per process.
+
+    Args:
+        model_name (str): The HuggingFace name of the SentenceTransformer model.
+        model_path (str): The local folder holding the ONNX model.
+        device (str): The device to run the model on.
+        batch_size (int): The batch size used when encoding documents.
+
+    Returns:
+        QuantizedEmbeddings: The shared embedding model.
+    """
+    return QuantizedEmbeddings(model_name, model_path, device, batch_size)
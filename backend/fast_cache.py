@@ -0,0 +1,65 @@
+import numpy as np
+from numba import njit, types
+
+@njit(cache=True, fastmath=True)
+def lsh_sign_pack(q, R, out_bits):
+    """
+    Computes the random-projection LSH signature of a query for every hash table.
+
+    Bit `b` of table `t`'s signature is set when the projection of `q` onto `R[t, b]` is positive.
+
+    The kernel is serial: it is called from several Python threads at once, which parallel
+    Numba kernels don't support under the default workqueue threading layer.
+
+    Args:
+        q (np.ndarray): The float32 query embedding, shape (dimensions,).
+        R (np.ndarray): The float32 projections, shape (num_tables, num_bits, dimensions), num_bits <= 64.
+        out_bits (np.ndarray): The uint64 output array, shape (num_tables,).
+
+    Returns:
+        None
+    """
+    num_tables, num_bits, dimensions = R.shape
+    for t in range(num_tables):
+        signature = np.uint64(0)
+        for b in range(num_bits):
+            acc = np.float32(0.0)
+            for d in range(dimensions):
+                acc += q[d] * R[t, b, d]
+            if acc > 0:
+                signature |= np.uint64(1) << np.uint64(b)
+        out_bits[t] = signature
+
+@njit(cache=True, fastmath=True)
+def cosine_topk(q, mat, norms, k):
+    """
+    Scores a set of candidate embeddings against a query by cosine similarity.
+
+    Args:
+        q (np.ndarray): The float32 query embedding, shape (dimensions,).
+        mat (np.ndarray): The float32 candidate embeddings, shape (num_candidates, dimensions).
+        norms (np.ndarray): The float32 L2 norms of the candidates, shape (num_candidates,).
+        k (int): The number of best candidates to return.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The indices of the top k candidates and their scores, best first.
+    """
+    num_candidates, dimensions = mat.shape
+    q_norm = np.float32(0.0)
+    for d in range(dimensions):
+        q_norm += q[d] * q[d]
+    q_norm = np.sqrt(q_norm)
+
+    scores = np.empty(num_candidates, dtype=np.float32)
+    for i in range(num_candidates):
+        acc = np.float32(0.0)
+        for d in range(dimensions):
+            acc += q[d] * mat[i, d]
+        scores[i] = acc / (q_norm * norms[i])
+
+    order = np.argsort(-scores)[:k]
+    return order, scores[order]
+
+# Compile the kernels at import so the first query doesn't pay the JIT cost
+lsh_sign_pack.compile((types.float32[::1], types.float32[:, :, ::1], types.uint64[::1]))
+cosine_topk.compile((types.float32[::1], types.float32[:, ::1], types.float32[::1], types.int64))
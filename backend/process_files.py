@@ -1,44 +1,164 @@
 #!/usr/bin/env python
 import shutil
+import errno
 import os
 import logging
-import tomli
 import warnings
-from langchain_community.embeddings.huggingface import HuggingFaceEmbeddings
+import uuid
+import multiprocessing
+from pathlib import Path
+import chromadb
+from chromadb.utils.batch_utils import create_batches
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from config import CFG
+from embeddings import get_embedder
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import Chroma
 from langchain_community.document_loaders import PyPDFLoader, TextLoader
+from langchain_community.document_loaders.parsers.pdf import extract_from_images_with_rapidocr
+from pypdf import PdfReader
 
 # Configuration
-with open("parameters.toml", "rb") as params:
-          config = tomli.load(params)
-
-logging.basicConfig(level = config["general"]["logging_level"])
-source_file_location = config["rag"]["source_file_location"]
-processed_file_location = config["rag"]["processed_file_location"]
-vector_store_path = config["rag"]["vector_store_path"]
-embedding_model = config["llm"]["embedding_model"]
-device = config["llm"]["device"]
-batch_size = config["llm"]["batch_size"]
-
-embed_model = HuggingFaceEmbeddings(
-        model_name = embedding_model,
-        model_kwargs = {"device": device},
-        encode_kwargs = {"device": device, "batch_size": batch_size}
-        )
+logging.basicConfig(level = CFG.general.logging_level)
+source_file_location = CFG.rag.source_file_location
+processed_file_location = CFG.rag.processed_file_location
+vector_store_path = CFG.rag.vector_store_path
+extract_images = CFG.rag.extract_images
+ocr_min_chars = CFG.rag.ocr_min_chars
+collection_name = CFG.rag.collection_name
+collection_metadata = CFG.rag.collection_metadata
+embedding_model = CFG.llm.embedding_model
+onnx_model_path = CFG.llm.onnx_model_path
+device = CFG.llm.device
+batch_size = CFG.llm.batch_size
 
 warnings.filterwarnings("ignore")
 
+def ocr_pages(path, data):
+    """
+    Runs OCR over the images of pages that have little or no extractable text.
+
+    Pages with at least `ocr_min_chars` characters of text are left as they are, so
+    text-heavy PDFs are never rasterised.
+
+    Parameters:
+    path (str): The path to the PDF.
+    data (list): The documents loaded from the PDF, one per page.
+
+    Returns:
+    None
+    """
+    reader = None
+    for document in data:
+        if len(document.page_content.strip()) >= ocr_min_chars:
+            continue
+        if reader is None:
+            reader = PdfReader(path)
+        images = [image.data for image in reader.pages[document.metadata["page"]].images]
+        if images:
+            document.page_content += extract_from_images_with_rapidocr(images)
+
+def load_and_split(file):
+    """
+    Loads a PDF and splits it into chunks.
+
+    This runs in a worker process, so it only needs the loader and splitter; the
+    embedding model stays in the main process.
+
+    Parameters:
+    file (str): The name of the file in the source folder.
+
+    Returns:
+    list: The chunks of the document.
+    """
+    path = f"{source_file_location}/{file}"
+    loader = PyPDFLoader(path, extract_images=False)
+    data = loader.load()
+    if extract_images:
+        ocr_pages(path, data)
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    return text_splitter.split_documents(data)
+
+def move_file(file):
+    """
+    Moves a file from the source folder to the processed folder.
+
+    A rename is a single system call when both folders are on the same filesystem;
+    otherwise the file is copied across with shutil.move. As with shutil.move, an
+    existing file of the same name in the processed folder is never overwritten.
+
+    Parameters:
+    file (str): The name of the file in the source folder.
+
+    Returns:
+    None
+    """
+    source = Path(source_file_location) / file
+    destination = Path(processed_file_location) / file
+    if destination.exists():
+        raise FileExistsError(f"Destination path '{destination}' already exists")
+    try:
+        source.rename(destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(source, destination)
+
+def flush(client, collection, embed_model, pending, pending_files):
+    """
+    Embeds and persists the pending chunks, then moves their source files.
+
+    The chunks are embedded in one call and written in batches no larger than the
+    client's `max_batch_size`, so a single large PDF can't exceed Chroma's limit.
+
+    Files are only moved once all of their chunks have been written to the vector store;
+    if the write fails they are left in place to be picked up by the next run. Note that
+    a failure partway through the batches leaves the earlier batches' chunks written, so
+    those files will have duplicate chunks once they are processed again. A file that
+    fails to move is logged and skipped without affecting the rest of the batch.
+
+    Parameters:
+    client (chromadb.ClientAPI): The Chroma client, used for its batch size limit.
+    collection (chromadb.Collection): The collection to add the chunks to.
+    embed_model (Embeddings): The model used to embed the chunks.
+    pending (list): The chunks waiting to be embedded.
+    pending_files (list): The files whose chunks are all in `pending`.
+
+    Returns:
+    None
+    """
+    try:
+        if pending:
+            texts = [document.page_content for document in pending]
+            batches = create_batches(
+                client,
+                ids=[str(uuid.uuid4()) for _ in pending],
+                embeddings=embed_model.embed_documents(texts),
+                documents=texts,
+                metadatas=[document.metadata for document in pending],
+            )
+            for ids, embeddings, metadatas, documents in batches:
+                collection.add(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+        for file in pending_files:
+            try:
+                move_file(file)
+                logging.info(f"{file} processed.")
+            except OSError as e:
+                logging.error(f"{file} was embedded but could not be moved: {e}")
+    finally:
+        pending.clear()
+        pending_files.clear()
+
 def process_files():
     """
     Process files in a given directory.
 
     This function iterates over all the files in a specified directory and performs the following steps for each file:
-    1. Loads the file using PyPDFLoader.
-    2. Splits the loaded document into smaller chunks of text using RecursiveCharacterTextSplitter.
-    3. Converts the text chunks into vector embeddings using an embed_model.
-    4. Persists the vector embeddings to a specified directory using Chroma.
-    5. Moves the processed file to a different location.
+    1. Loads the file using PyPDFLoader, running OCR only on pages without text if `extract_images` is set,
+       and splits it into smaller chunks of text using RecursiveCharacterTextSplitter.
+       This happens in a pool of worker processes so that loading overlaps with embedding.
+    2. Queues the chunks until there are enough to fill several embedding batches.
+    3. Converts the queued chunks into vector embeddings using an embed_model and persists them with Chroma.
+    4. Moves the processed files to a different location.
 
     If any exception occurs during the processing of a file, it will be logged as an error.
 
@@ -48,21 +168,47 @@ def process_files():
     Returns:
     None
     """
-    files = [x for x in os.listdir(f"{source_file_location}")]
-
-    for file in files:
-        logging.info(file)
-        try:
-            loader = PyPDFLoader(f"{source_file_location}/{file}", extract_images=True)
-            data = loader.load()
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-            all_splits = text_splitter.split_documents(data)
-            Chroma.from_documents(documents=all_splits, embedding=embed_model, persist_directory=vector_store_path)
-            logging.info(f"{file} processed.")
-            shutil.move(os.path.join(f"{source_file_location}", file), f"{processed_file_location}")
-
-        except Exception as e:
-            logging.error(e)
+    with os.scandir(source_file_location) as entries:
+        files = [entry.name for entry in entries if entry.is_file()]
+    pending = []
+    pending_files = []
+
+    # Workers are spawned rather than forked so they never inherit the ONNX Runtime session
+    # (and its thread pool) or the Chroma client created below
+    executor = ProcessPoolExecutor(
+        max_workers=max(1, os.cpu_count() // 2),
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    with executor:
+        futures = {executor.submit(load_and_split, file): file for file in files}
+
+        # Exports the INT8 quantized ONNX model on first run, then reuses it
+        embed_model = get_embedder(
+                model_name = embedding_model,
+                model_path = onnx_model_path,
+                device = device,
+                batch_size = batch_size
+                )
+        client = chromadb.PersistentClient(path=vector_store_path)
+        collection = client.get_or_create_collection(collection_name, metadata=collection_metadata)
+
+        for future in as_completed(futures):
+            # Drop the future once it's consumed so its chunks can be freed after the next flush
+            file = futures.pop(future)
+            logging.info(file)
+            try:
+                pending.extend(future.result())
+                pending_files.append(file)
+                if len(pending) >= batch_size * 8:
+                    flush(client, collection, embed_model, pending, pending_files)
+
+            except Exception as e:
+                logging.error(e)
+
+    try:
+        flush(client, collection, embed_model, pending, pending_files)
+    except Exception as e:
+        logging.error(e)
 
 if __name__ == "__main__":
     process_files()
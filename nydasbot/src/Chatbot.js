@@ -7,6 +7,11 @@ function ChatApp() {
   const [input, setInput] = useState('');
   const [messages, setMessages] = useState([]);
   const websocket = useRef(null);
+  // The number of messages appended so far, kept outside of state so the index of a new message
+  // is known before React applies the update
+  const messageCount = useRef(0);
+  // The index of the bot message currently being streamed in, or null if none is
+  const streamingIndex = useRef(null);
 
   // useEffect is a React Hook that allows you to perform side effects in function components.
   // In this case, it's used to establish a WebSocket connection when the component mounts, 
@@ -22,8 +27,30 @@ function ChatApp() {
 
       // If the data contains an 'answer', append it to the messages array
       if (data.answer) {
+        messageCount.current += 1;
         setMessages((prevMessages) => [...prevMessages, `${data.answer}`]);
       }
+
+      // If the data contains a 'partial' answer, start a new message or extend the one being streamed.
+      // The server marks the last part of an answer with 'done'.
+      if (data.partial !== undefined) {
+        if (streamingIndex.current === null) {
+          streamingIndex.current = messageCount.current;
+          messageCount.current += 1;
+          setMessages((prevMessages) => [...prevMessages, data.partial]);
+        } else {
+          const index = streamingIndex.current;
+          setMessages((prevMessages) => prevMessages.map((msg, i) => i === index ? msg + data.partial : msg));
+        }
+        if (data.done) {
+          streamingIndex.current = null;
+        }
+      }
+
+      // An error ends the answer being streamed, as no 'done' frame will follow it
+      if (data.error) {
+        streamingIndex.current = null;
+      }
     };
 
     // Return a cleanup function to be run when the component unmounts
@@ -50,6 +77,7 @@ function ChatApp() {
       websocket.current.send(message);
 
       // Append the message to the messages array
+      messageCount.current += 1;
       setMessages((prevMessages) => [...prevMessages, `You: ${input}`]);
 
       // Clear the input field after sending the message